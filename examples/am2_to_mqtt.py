@@ -9,6 +9,7 @@
 """
 
 import os
+import sys
 import time
 import logging
 import json
@@ -17,19 +18,23 @@ import argparse
 import minimalmodbus
 import paho.mqtt.client as mqtt
 import hubble_lithium_am2 as am2
+from mqtt_outbox import MqttOutbox, DROP_POLICIES
 
 # globals
-instrument = None
+instruments = None
 args = None
 logger = None
 mqtt_client = None
+mqtt_outbox = None
 
-def mqtt_publish(topic: str, payload: str, retain: bool = False, wait: bool = False) -> None:
-    """publish payload on mqtt topic"""
+def mqtt_publish(topic: str, payload: str, retain: bool = False) -> None:
+    """queue payload on mqtt topic - published by mqtt_outbox, never blocks the poll loop"""
     logger.debug("topic=%s, payload=%s", topic, payload)
-    infot = mqtt_client.publish(topic=topic, payload=payload, qos=0, retain=retain)
-    if wait:
-        infot.wait_for_publish()
+    if mqtt_outbox is None:
+        # --replay: straight to paho, no spool or drain rate limit
+        mqtt_client.publish(topic=topic, payload=payload, retain=retain)
+        return
+    mqtt_outbox.put(topic=topic, payload=payload, retain=retain)
 
 
 # https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes
@@ -51,6 +56,15 @@ def get_device_class(key: str):
     return DEVICE_CLASS_DICT[key] if key in DEVICE_CLASS_DICT else None
 
 
+def get_device_id(battery) -> str:
+    """return mqtt device_id of a AM2battery or the AM2Bank
+    station_address is unique across the bank, AM2multiport.discover() refuses duplicates
+    """
+    if isinstance(battery, am2.AM2Bank):
+        return "am2_bank"
+    return f"am2_battery_{battery.station_address}"
+
+
 def mqtt_publish_hass_discovery(base_topic: str, battery):
     """
     HASS discovery - publish AM2 register information via mqtt
@@ -61,13 +75,14 @@ def mqtt_publish_hass_discovery(base_topic: str, battery):
     """
 
     # static information
-    addr = battery.station_address
     manufacturer = "Hubble Lithium"
     model = "AM2 48V 5.5kWh"
     sw_version = battery.get_string('Version')
     hw_version = "AM2 Lithium ion"
-    device_name = f"AM2_battery_{addr}" # display name
-    device_id = f"am2_battery_{addr}"   # same in mqtt_publish_state()
+    device_id = get_device_id(battery)  # same in mqtt_publish_state()
+    device_name = "AM2_" + device_id[4:] # display name
+    if isinstance(battery, am2.AM2Bank):
+        model = "AM2 48V bank"
     identifiers = [device_id]
 
     # for every register create a disovery_topic & discovery_payload, then mqtt_publish
@@ -105,6 +120,8 @@ def mqtt_publish_hass_discovery(base_topic: str, battery):
         device_class = get_device_class(unit_of_measure)
         if device_class:
             discovery_payload["device_class"] = device_class
+        if unit_of_measure == "Wh":
+            discovery_payload["state_class"] = "total_increasing" # Energy_Charge/Energy_Discharge for HASS energy dashboard
 
         logger.info("discovery_topic=%s,\ndiscovery_payload=%s", discovery_topic, json.dumps(discovery_payload,indent=4))
 
@@ -116,8 +133,7 @@ def mqtt_publish_hass_discovery(base_topic: str, battery):
 
 def mqtt_publish_state(base_topic: str, battery):
     """ loop thru registers and publish via mqtt """
-    addr = battery.station_address
-    device_id = f"am2_battery_{addr}"
+    device_id = get_device_id(battery)
 
     for key, reg_data in battery:
         reg = battery.register_data[key]
@@ -137,7 +153,7 @@ def setup_args() -> None:
     global args
     parser = argparse.ArgumentParser(description="AM2 to HASS via MQTT example app")
 
-    parser.add_argument("--device", help="RS485 device, e.g. /dev/ttyUSB1", type=str, required=True)
+    parser.add_argument("--device", help="RS485 device(s), e.g. /dev/ttyUSB1, several devices are polled in parallel", type=str, nargs="+")
     parser.add_argument("--max-address", help="Max modbus station address to read, default=1", type=int, default=1)
     parser.add_argument("--mqtt", help="MQTT enable message publish", action="store_true")
     parser.add_argument("--mqtt-user", help="MQTT username", type=str) # WARNING: passing passwords on cmd line is not secure
@@ -147,10 +163,23 @@ def setup_args() -> None:
     parser.add_argument("--mqtt-topic", help="MQTT topic, default 'hubble_am2'", type=str, default="hubble_am2")
     parser.add_argument("--mqtt-hass", help="MQTT enable Home Assistant discovery", action="store_true")
     parser.add_argument("--mqtt-hass-retain", help="MQTT enable retain HASS discovery mesages", action="store_true")
+    parser.add_argument("--mqtt-queue-dir", help="MQTT spill queue to this dir while broker is down, default am2_mqtt_queue", type=str, default="am2_mqtt_queue")
+    parser.add_argument("--mqtt-queue-memory", help="MQTT messages queued in memory before spill to disk, default=10000", type=int, default=10000)
+    parser.add_argument("--mqtt-queue-disk", help="MQTT max queue files on disk, default=100", type=int, default=100)
+    parser.add_argument("--mqtt-queue-retention", help="MQTT seconds to keep queued messages, default=86400", type=int, default=86400)
+    parser.add_argument("--mqtt-queue-drop", help="MQTT drop 'oldest' or 'newest' when queue is full, default=oldest", choices=DROP_POLICIES, default="oldest")
+    parser.add_argument("--mqtt-drain-rate", help="MQTT max messages/second when draining queue, default=200", type=float, default=200)
     parser.add_argument("--debug", help="Enable debug output", action="store_true")
     parser.add_argument("--sleep", help="Seconds bettwen sampling loop, default=60", type=int, default=60)
+    parser.add_argument("--bank", help="Publish AM2 bank aggregate device (total power, SoC, energy)", action="store_true")
+    parser.add_argument("--bank-state-file", help="File to persist bank energy counters, default am2_bank.json", type=str, default="am2_bank.json")
+    parser.add_argument("--capture", help="Capture all modbus frames to journal file", type=str)
+    parser.add_argument("--replay", help="Replay journal file instead of reading --device", type=str)
+    parser.add_argument("--replay-speed", help="Replay speed, 1=original pacing, default=0 as fast as possible", type=float, default=0.0)
 
     args = parser.parse_args()
+    if not args.device and not args.replay:
+        parser.error("one of --device or --replay is required")
 
     #arg.mqtt_topic should only be alpha,numeric,-,_ and no /
     #mqtt_topic = ''.join([c for c in args.mqtt_topic if c.isalnum() or c in ['-','_']])
@@ -167,40 +196,105 @@ def setup_logger() -> None:
 
 
 def setup_instrument() -> None:
-    """ setup rs485 device """
-    global instrument
+    """ setup rs485 device(s) """
+    global instruments
     # open the instrument aka device
     # this is done ouside of the AM2battery class so you can adjust any serial settings
-    logger.info("minimalmodbus: Connecting to %s",args.device)
-    instrument = minimalmodbus.Instrument(port=args.device, slaveaddress=1, debug=False, close_port_after_each_call=True)
-    instrument.serial.baudrate = 9600
-    logger.info("minimalmodbus: instrument=%s",instrument)
+    instruments = []
+    for device in args.device:
+        logger.info("minimalmodbus: Connecting to %s",device)
+        instrument = minimalmodbus.Instrument(port=device, slaveaddress=1, debug=False, close_port_after_each_call=True)
+        instrument.serial.baudrate = 9600
+        logger.info("minimalmodbus: instrument=%s",instrument)
+        instruments.append(instrument)
 
 
 def setup_mqtt_client() -> None:
-    """ connect to mqtt """
-    global mqtt_client
+    """ connect to mqtt - paho network thread reconnects, mqtt_outbox holds messages while disconnected """
+    global mqtt_client, mqtt_outbox
     client_name = os.path.basename(__file__)
     logger.info("setup_mqtt_client: connecting=%s",args.mqtt_broker)
     mqtt_client = mqtt.Client(client_name)
     #mqtt_client.enable_logger(logger)
     mqtt_client.username_pw_set(args.mqtt_user, args.mqtt_password)
-    mqtt_client.connect(args.mqtt_broker, port=args.mqtt_port)
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=60)
+    mqtt_client.connect_async(args.mqtt_broker, port=args.mqtt_port)
+    mqtt_client.loop_start()
+    if args.replay:
+        # replayed messages would fill the live spool with fresh timestamps - publish directly instead
+        for _ in range(100):
+            if mqtt_client.is_connected():
+                return
+            time.sleep(0.1)
+        logger.error("setup_mqtt_client: can't connect to %s, not replaying", args.mqtt_broker)
+        sys.exit(1)
+    mqtt_outbox = MqttOutbox(mqtt_client, spool_dir=args.mqtt_queue_dir,
+                             memory_limit=args.mqtt_queue_memory, disk_limit=args.mqtt_queue_disk,
+                             retention=args.mqtt_queue_retention, drop_policy=args.mqtt_queue_drop,
+                             drain_rate=args.mqtt_drain_rate)
+
+
+def replay() -> None:
+    """ replay a captured journal thru publish, log replay rate vs real time """
+    logger.info("replaying journal=%s, speed=%0.1f", args.replay, args.replay_speed)
+    journal = am2.AM2replay(args.replay, speed=args.replay_speed)
+    start_time = time.monotonic()
+    cycles = {} # station_address: number of read cycles replayed
+    for battery in journal:
+        addr = battery.station_address
+        # publish discovery every 15 cycles, as the live loop does
+        if cycles.get(addr, 0) % 15 == 0:
+            mqtt_publish_hass_discovery(args.mqtt_topic, battery)
+        cycles[addr] = cycles.get(addr, 0) + 1
+        mqtt_publish_state(args.mqtt_topic, battery)
+
+    elapsed = time.monotonic() - start_time
+    if mqtt_client:
+        # disconnect is sent after the queued messages, loop_stop waits for it
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+    logger.warning("replay done: frames=%d, errors=%d, cycles=%d, journal_time=%0.1fs, replay_time=%0.3fs, "
+                   "x%0.0f real time, %0.0f frames/s",
+                   journal.frame_count, journal.error_count, journal.cycle_count, journal.journal_time, elapsed,
+                   journal.journal_time / elapsed if elapsed > 0 else 0,
+                   journal.frame_count / elapsed if elapsed > 0 else 0)
 
 
 def main() -> None:
     """ setup and loop """
     setup_args()
     setup_logger()
-    setup_instrument()
     if args.mqtt:
         setup_mqtt_client()
+    if args.replay:
+        replay()
+        return
+    setup_instrument()
+    if args.capture:
+        logger.info("capturing modbus frames to %s", args.capture)
+        am2.start_capture(args.capture)
 
     bank={}
     bank_range = range(1, args.max_address + 1)
-    for addr in bank_range:
-        logger.info("Connecting to battery.addr=%d",addr)
-        bank[addr] = am2.AM2battery(instrument, station_address=addr)
+    # a few missed loops don't stop energy integration, a longer outage isn't guessed
+    bank_total = am2.AM2Bank(args.bank_state_file, max_gap=3 * args.sleep) if args.bank else None
+    multiport = None
+    if len(instruments) > 1:
+        # several RS485 ports - find which battery answers on which port, poll ports in parallel
+        multiport = am2.AM2multiport(instruments, max_address=args.max_address)
+        try:
+            multiport.discover()
+        except ValueError as ex:
+            # station_address is the mqtt device id - batteries would overwrite each other
+            logger.error("%s", ex)
+            sys.exit(1)
+        if not multiport.bank:
+            logger.error("no batteries found on %d ports, addresses 1..%d - probing again every %d reads",
+                         len(instruments), args.max_address, multiport.reprobe_every)
+    else:
+        for addr in bank_range:
+            logger.info("Connecting to battery.addr=%d",addr)
+            bank[addr] = am2.AM2battery(instruments[0], station_address=addr)
 #        bank[addr].read_battery()
 #        if args.mqtt and args.mqtt_hass:
 #            logger.info("publishing hass discovery battery.addr=%d",addr)
@@ -209,21 +303,40 @@ def main() -> None:
     loop_count = 0
     start_time = time.time()
     while True:
-        for addr in bank_range:
-            logger.info("reading battery.addr=%d",addr)
-            battery = bank[addr]
-            battery.read_battery()
-
+        if multiport:
+            logger.info("reading %d batteries on %d ports", len(multiport.bank), len(instruments))
+            batteries = multiport.read_bank()
+        else:
+            batteries = []
+            for addr in bank_range:
+                logger.info("reading battery.addr=%d",addr)
+                bank[addr].read_battery()
+                batteries.append(bank[addr])
+
+        for battery in batteries:
+            addr = battery.station_address
             # publish discovery every 15 minutes
             if loop_count % 15 == 0:
                 logger.info("publishing hass discovery battery.addr=%d",addr)
-                mqtt_publish_hass_discovery(args.mqtt_topic, bank[addr])
+                mqtt_publish_hass_discovery(args.mqtt_topic, battery)
 
             logger.info("publishing battery.addr=%d",addr)
-            mqtt_publish_state(args.mqtt_topic, bank[addr])
+            mqtt_publish_state(args.mqtt_topic, battery)
+
+        if bank_total is not None:
+            # aggregate from this read cycle of all batteries
+            bank_total.update(batteries)
+            if loop_count % 15 == 0:
+                mqtt_publish_hass_discovery(args.mqtt_topic, bank_total)
+            mqtt_publish_state(args.mqtt_topic, bank_total)
 
         loop_count += 1
+        if args.capture:
+            am2.flush_capture()
         logger.info("============= sleep %d, loop_count=%d, am2_read_count=%d, am2_read_errors=%d ===========", args.sleep, loop_count, am2.get_read_count(), am2.get_read_errors())
+        if mqtt_outbox:
+            logger.info("mqtt_outbox: connected=%s, queued=%d, published=%d, dropped=%d",
+                        mqtt_client.is_connected(), mqtt_outbox.queued(), mqtt_outbox.published, mqtt_outbox.dropped)
 
         time.sleep(args.sleep - (time.time() - start_time) % args.sleep)
 
@@ -1,6 +1,7 @@
 # Alberto - Nov 2022
 
 # bank of 4 batteries connected to /dev/ttyUSB1
+# for a bank split over several adapters use eg --device /dev/ttyUSB0 /dev/ttyUSB1
 
 python3 am2_to_mqtt.py --device=/dev/ttyUSB1 --max-address 4 \
                        --mqtt --mqtt-broker localhost \
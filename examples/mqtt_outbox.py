@@ -0,0 +1,272 @@
+"""
+    Description: Bounded outbound mqtt queue, spills to disk while the broker is unreachable
+    Author:     Alberto da Silva
+
+    The poll loop only calls put() - this never blocks on the broker or the disk.
+    A background thread drains the queue in rate limited batches while connected.
+    When the memory queue is full it is handed to the background thread which writes
+    it to a segment file in spool_dir. Segments are drained first (oldest data first)
+    and survive a restart.
+    Messages are published with QoS 1, a segment file is only removed once the broker
+    has acknowledged all of its messages - a crash or half open connection while draining
+    re-sends the segment (at least once delivery).
+"""
+
+import os
+import time
+import json
+import logging
+import threading
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+DROP_POLICIES = ('oldest', 'newest')
+
+
+class MqttOutbox:
+    """Bounded, disk spilling queue between the poll loop and the mqtt client"""
+    def __init__(self, mqtt_client, spool_dir: str = None, memory_limit: int = 10000, disk_limit: int = 100,
+                 retention: float = 86400, drop_policy: str = 'oldest',
+                 drain_rate: float = 200, drain_batch: int = 100) -> None:
+        """constructor
+        memory_limit = messages held in memory before spilling a segment to spool_dir
+        disk_limit   = max segment files in spool_dir, spool_dir=None = memory only
+        retention    = seconds, older messages are dropped instead of published
+        drop_policy  = 'oldest' drop the oldest data when full, 'newest' drop new messages
+        drain_rate   = max messages per second published on reconnect
+        drain_batch  = messages per batch, also max messages waiting for broker acknowledge
+        """
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"drop_policy must be one of {DROP_POLICIES}")
+        self.mqtt_client = mqtt_client
+        self.spool_dir = spool_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.retention = retention
+        self.drop_policy = drop_policy
+        self.drain_rate = drain_rate
+        self.drain_batch = drain_batch
+
+        # shared with put() - only held for deque operations, never for disk or network I/O
+        self.lock = threading.Lock()
+        self.memory = deque()   # newest messages: (timestamp, topic, payload, retain)
+        self.spills = deque()   # full memory chunks waiting to be written to a segment
+        self.writing = 0        # messages in the chunk being written
+        self.published = 0
+        self.dropped = 0
+
+        # only used by the background thread
+        self.wakeup = threading.Event()
+        self.segments = deque() # segment file names waiting to be drained, oldest first
+        self.segment_seq = 0
+        self.current_segment = None # segment being drained, removed once all messages are acknowledged
+        self.draining = deque() # messages of current_segment not yet published
+        self.segment_unacked = 0 # messages of current_segment published but not acknowledged
+        self.inflight = [] # (from_segment, message, MQTTMessageInfo) waiting for broker acknowledge
+
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+            self.segments.extend(sorted(f for f in os.listdir(spool_dir) if f.endswith(".jsonl")))
+            if self.segments:
+                self.segment_seq = int(self.segments[-1].split(".")[0]) + 1
+                logger.info("mqtt_outbox: %d segments left from previous run in %s", len(self.segments), spool_dir)
+
+        self.thread = threading.Thread(target=self.run, name="mqtt_outbox", daemon=True)
+        self.thread.start()
+
+    def put(self, topic: str, payload, retain: bool = False) -> None:
+        """queue a message for publish - never blocks on the broker or the disk"""
+        with self.lock:
+            if len(self.memory) >= self.memory_limit:
+                disk_room = len(self.spills) + len(self.segments) < self.disk_limit
+                if self.spool_dir and (disk_room or self.drop_policy == 'oldest'):
+                    # background thread writes the chunk to disk, drops the oldest segment if the disk is full
+                    if len(self.spills) >= self.disk_limit:
+                        self.dropped += len(self.spills.popleft()) # writer far behind - bound memory
+                    self.spills.append(self.memory)
+                    self.memory = deque()
+                elif self.drop_policy == 'newest':
+                    self.dropped += 1
+                    return
+                else:
+                    self.memory.popleft()
+                    self.dropped += 1
+            self.memory.append((time.time(), topic, payload, retain))
+        self.wakeup.set()
+
+    def count(self, published: int = 0, dropped: int = 0) -> None:
+        """update published/dropped counters"""
+        with self.lock:
+            self.published += published
+            self.dropped += dropped
+
+    def segment_path(self, segment: str) -> str:
+        """path of a segment file"""
+        return os.path.join(self.spool_dir, segment)
+
+    def write_spills(self) -> None:
+        """write memory chunks handed over by put() to segment files"""
+        while True:
+            with self.lock:
+                if not self.spills:
+                    return
+                chunk = self.spills.popleft()
+                self.writing = len(chunk) # for queued()
+            self.write_segment(chunk)
+            with self.lock:
+                self.writing = 0
+
+    def write_segment(self, chunk: deque) -> None:
+        """write one chunk of messages to a new segment file, apply drop_policy when the disk queue is full"""
+        if len(self.segments) >= self.disk_limit:
+            if self.drop_policy == 'newest':
+                self.count(dropped=len(chunk))
+                return
+            oldest = self.segments.popleft()
+            try:
+                with open(self.segment_path(oldest), encoding='utf-8') as seg:
+                    self.count(dropped=sum(1 for _ in seg))
+                os.remove(self.segment_path(oldest))
+            except OSError as ex:
+                logger.warning("mqtt_outbox: can't drop segment=%s, exception=%s", oldest, ex)
+
+        segment = f"{self.segment_seq:08d}.jsonl"
+        self.segment_seq += 1
+        try:
+            with open(self.segment_path(segment), 'w', encoding='utf-8') as seg:
+                for message in chunk:
+                    seg.write(json.dumps(message) + "\n")
+        except OSError as ex:
+            logger.warning("mqtt_outbox: can't spill to %s, dropped %d messages, exception=%s", segment, len(chunk), ex)
+            self.count(dropped=len(chunk))
+            return
+        self.segments.append(segment)
+        logger.info("mqtt_outbox: spilled segment=%s, segments=%d, dropped=%d", segment, len(self.segments), self.dropped)
+
+    def load_segment(self) -> None:
+        """make the oldest segment file the current_segment, its messages go to the draining queue"""
+        segment = self.segments.popleft()
+        try:
+            with open(self.segment_path(segment), encoding='utf-8') as seg:
+                for line in seg:
+                    self.draining.append(tuple(json.loads(line)))
+        except (OSError, ValueError) as ex:
+            logger.warning("mqtt_outbox: skipping segment=%s, exception=%s", segment, ex)
+        self.current_segment = segment
+        self.segment_unacked = 0
+
+    def check_inflight(self) -> None:
+        """count acknowledged messages, remove current_segment once all its messages are acknowledged"""
+        inflight = []
+        published = 0
+        for from_segment, message, infot in self.inflight:
+            try:
+                acknowledged = infot.is_published()
+            except (RuntimeError, ValueError) as ex: # paho raises if the publish failed
+                logger.warning("mqtt_outbox: publish topic=%s failed, exception=%s", message[1], ex)
+                if from_segment:
+                    self.segment_unacked -= 1
+                self.requeue([message], from_segment)
+                continue
+            if acknowledged:
+                published += 1
+                if from_segment:
+                    self.segment_unacked -= 1
+            else:
+                inflight.append((from_segment, message, infot))
+        self.inflight = inflight
+        self.count(published=published)
+
+        if self.current_segment and not self.draining and self.segment_unacked == 0:
+            try:
+                os.remove(self.segment_path(self.current_segment))
+            except OSError as ex:
+                logger.warning("mqtt_outbox: can't remove segment=%s, exception=%s", self.current_segment, ex)
+            self.current_segment = None
+
+    def next_batch(self) -> tuple:
+        """return up to drain_batch messages oldest first, and True if they are from current_segment"""
+        if self.current_segment is None and self.segments:
+            self.load_segment()
+        if self.current_segment is not None:
+            # memory is newer than any segment - wait until the segment is acknowledged
+            batch = [self.draining.popleft() for _ in range(min(self.drain_batch, len(self.draining)))]
+            return batch, True
+        with self.lock:
+            if self.spills:
+                return [], False # older than memory, write to disk first
+            batch = [self.memory.popleft() for _ in range(min(self.drain_batch, len(self.memory)))]
+        return batch, False
+
+    def requeue(self, messages: list, from_segment: bool) -> None:
+        """put messages back at the head of their queue, published again after reconnect"""
+        if from_segment:
+            self.draining.extendleft(reversed(messages))
+        else:
+            with self.lock:
+                self.memory.extendleft(reversed(messages))
+
+    def publish_batch(self, batch: list, from_segment: bool) -> None:
+        """publish a batch with QoS 1, paho re-sends unacknowledged messages on reconnect"""
+        expired = time.time() - self.retention
+        dropped = 0
+        for index, message in enumerate(batch):
+            timestamp, topic, payload, retain = message
+            if timestamp < expired:
+                dropped += 1
+                continue
+            infot = self.mqtt_client.publish(topic=topic, payload=payload, qos=1, retain=retain)
+            if infot.rc == mqtt.MQTT_ERR_NO_CONN:
+                # connection dropped since is_connected() - keep the rest of the batch for the next connect
+                self.requeue(batch[index:], from_segment)
+                break
+            if infot.rc != mqtt.MQTT_ERR_SUCCESS:
+                logger.warning("mqtt_outbox: publish topic=%s failed, rc=%d", topic, infot.rc)
+                dropped += 1
+                continue
+            self.inflight.append((from_segment, message, infot))
+            if from_segment:
+                self.segment_unacked += 1
+        self.count(dropped=dropped)
+
+    def run(self) -> None:
+        """background thread - keeps running whatever fails in drain()"""
+        while True:
+            try:
+                self.drain()
+            except Exception: # pylint: disable=broad-except
+                logger.exception("mqtt_outbox: unexpected error, retrying")
+                time.sleep(1.0)
+
+    def drain(self) -> None:
+        """write spills, drain queue in rate limited batches while connected"""
+        while True:
+            self.wakeup.wait(timeout=1.0)
+            self.wakeup.clear()
+            self.write_spills()
+            self.check_inflight()
+            while self.mqtt_client.is_connected():
+                self.write_spills()
+                self.check_inflight()
+                if len(self.inflight) >= self.drain_batch:
+                    time.sleep(0.1) # wait for broker acknowledge, eg half open connection
+                    continue
+                batch, from_segment = self.next_batch()
+                if not batch:
+                    if not self.inflight and not self.current_segment:
+                        break
+                    time.sleep(0.1)
+                    continue
+                start_time = time.monotonic()
+                self.publish_batch(batch, from_segment)
+                time.sleep(max(0.0, len(batch) / self.drain_rate - (time.monotonic() - start_time)))
+
+    def queued(self) -> int:
+        """approximate number of messages waiting to be published or acknowledged"""
+        with self.lock:
+            queued = len(self.memory) + sum(len(chunk) for chunk in self.spills) + self.writing
+        return (queued + len(self.draining) + len(self.inflight)
+                + len(self.segments) * self.memory_limit + (1 if self.current_segment else 0))
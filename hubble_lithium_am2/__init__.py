@@ -2,3 +2,4 @@
 # required for pip
 
 from .hubble_lithium_am2 import *
+from .journal import *
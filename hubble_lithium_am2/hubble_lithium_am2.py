@@ -8,6 +8,10 @@
                         rename pack to battery
                         rename registers to better group
                         Track read errors in read_registers
+                 0.9.3 - optional capture of modbus frames to a journal
+                        AM2replay - replay a journal offline
+                        AM2Bank - bank aggregate of all batteries with energy counters
+                        AM2multiport - poll a bank over several RS485 ports in parallel
     License:     MIT
     Copyright:   2022 (c) Alberto da Silva
     DISCLAIMER:  Use at your own risk!
@@ -33,11 +37,19 @@
     Possible enahancement: use constants/enum for registers
 """
 
+import os
+import json
 import time
+import random
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from ctypes import c_int16
 from dataclasses import dataclass
 
+from .journal import (FrameJournal, RECORD_FRAME, RECORD_ERROR, RECORD_CYCLE,
+                      build_request_frame, build_response_frame, parse_request_frame, parse_response_frame)
+
 # Globals
 logger = logging.getLogger(__name__)
 
@@ -110,6 +122,25 @@ AM2_STRING_DICT = {
 }
 
 
+"""Registers of the AM2Bank aggregate - computed from one read cycle of all batteries"""
+AM2_BANK_REGISTERS_DICT = { # dict
+     2000: {'name':'Power',            'unit':'W',  'factor':'comp', 'count':1},
+     2001: {'name':'Current',          'unit':'A',  'factor':'comp', 'count':1},
+     2002: {'name':'Voltage',          'unit':'V',  'factor':'comp', 'count':1}, # avg
+     2003: {'name':'SoC',              'unit':'%',  'factor':'comp', 'count':1}, # weighted by Capacity_Full
+     2004: {'name':'Capacity_Remain',  'unit':'Ah', 'factor':'comp', 'count':1},
+     2005: {'name':'Capacity_Full',    'unit':'Ah', 'factor':'comp', 'count':1},
+     2006: {'name':'Vcell_min',        'unit':'V',  'factor':'comp', 'count':1},
+     2007: {'name':'Vcell_min_address','unit':'int','factor':'comp', 'count':1}, # battery with Vcell_min
+     2008: {'name':'Vcell_max',        'unit':'V',  'factor':'comp', 'count':1},
+     2009: {'name':'Vcell_max_address','unit':'int','factor':'comp', 'count':1}, # battery with Vcell_max
+     2010: {'name':'Energy_Charge',    'unit':'Wh', 'factor':'comp', 'count':1}, # integral of Power > 0
+     2011: {'name':'Energy_Discharge', 'unit':'Wh', 'factor':'comp', 'count':1}, # integral of Power < 0
+     2012: {'name':'Batteries',        'unit':'int','factor':'comp', 'count':1},
+     2013: {'name':'Time',             'unit':'tm', 'factor':'comp', 'count':1}
+}
+
+
 def get_name(key: int):
     """return name from the dict()"""
     return AM2_REGISTERS_DICT[key]['name'] if key in AM2_REGISTERS_DICT else "unknown_reg_" + str(key)
@@ -162,6 +193,7 @@ def scale_raw_register(factor: str, register_raw: int, register_scaled):
 # If you experience high number of errors, you may need 120Ω termination resistor on the cable
 AM2_READ_COUNT = 0
 AM2_READ_ERRORS = 0
+AM2_READ_LOCK = threading.Lock() # AM2multiport reads from one thread per port
 
 def get_read_count():
     return AM2_READ_COUNT
@@ -169,17 +201,75 @@ def get_read_count():
 def get_read_errors():
     return AM2_READ_ERRORS
 
+
+# optional capture of every modbus request/response to a FrameJournal, see start_capture()
+AM2_CAPTURE = None
+
+def start_capture(path: str) -> None:
+    """capture all modbus frames from read_registers to journal file path (append)"""
+    global AM2_CAPTURE
+    stop_capture()
+    AM2_CAPTURE = FrameJournal(path, 'ab')
+
+def stop_capture() -> None:
+    """stop capture and close the journal"""
+    global AM2_CAPTURE
+    capture, AM2_CAPTURE = AM2_CAPTURE, None
+    if capture is not None:
+        capture.close()
+
+def flush_capture() -> None:
+    """flush captured frames to disk, eg once per sampling loop"""
+    if AM2_CAPTURE is not None:
+        AM2_CAPTURE.flush()
+
+def capture_frames(station_address: int, register_address: int, number_of_registers: int,
+                   raw_result, t_request: float) -> None:
+    """write one request/response to the capture journal, raw_result = list or the exception of a failed read"""
+    request = build_request_frame(station_address, register_address, number_of_registers)
+    if isinstance(raw_result, Exception):
+        capture_write('write_error', t_request, time.monotonic(), request, raw_result)
+    else:
+        capture_write('write', t_request, time.monotonic(), request, build_response_frame(station_address, raw_result))
+
+def capture_write(method: str, *record) -> None:
+    """call FrameJournal.method(*record) on the capture journal
+    capture is for debugging only - if the journal can't be written, capture is disabled, reads carry on
+    """
+    global AM2_CAPTURE
+    capture = AM2_CAPTURE
+    if capture is None:
+        return
+    try:
+        getattr(capture, method)(*record)
+    except (OSError, ValueError) as ex:
+        if AM2_CAPTURE is capture: # log once, other threads may fail on the same journal
+            AM2_CAPTURE = None
+            logger.warning("capture disabled: journal=%s, exception=%s", capture.path, ex)
+
+def read_registers_once(instrument, register_address: int, number_of_registers: int = 1) -> list:
+    """ one read of count registers, no retry - counted in read_count/read_errors and captured, raises on failure """
+    global AM2_READ_COUNT, AM2_READ_ERRORS
+    with AM2_READ_LOCK:
+        AM2_READ_COUNT += 1
+    t_request = time.monotonic()
+    try:
+        raw_result = instrument.read_registers(registeraddress=register_address, number_of_registers=number_of_registers) # LIST
+    except Exception as ex:
+        with AM2_READ_LOCK:
+            AM2_READ_ERRORS += 1
+        capture_frames(instrument.address, register_address, number_of_registers, ex, t_request)
+        raise
+    capture_frames(instrument.address, register_address, number_of_registers, raw_result, t_request)
+    return raw_result
+
 def read_registers(instrument, register_address: int, number_of_registers: int = 1) -> list:
     """ read count registers = returns a List """
-    global AM2_READ_COUNT, AM2_READ_ERRORS
     for _ in range(AM2_READ_RETRY):
-        AM2_READ_COUNT += 1
         try:
-            raw_result = instrument.read_registers(registeraddress=register_address, number_of_registers=number_of_registers) # LIST
-            return raw_result
+            return read_registers_once(instrument, register_address, number_of_registers)
         except Exception as ex:
             exception_save = ex
-            AM2_READ_ERRORS += 1
             time.sleep(AM2_READ_DELAY)
 
     logger.warning("Exception: register_address=%d, number_of_registers=%d, exception=%s, roundtrip_time=%0.3f, read_retry=%d, read_count=%d, read_errors=%d",
@@ -203,20 +293,27 @@ class Register:
         self.register_raw: int = None  # register value from BMS
         self.register_scaled = "??" if self.unit == "str" else 0
 
-    def read_1_register(self, instrument) -> None:
-        """read a Register from the instrument"""
+    def read_1_register(self, instrument) -> bool:
+        """read a Register from the instrument, return False if the read failed"""
         factor = get_factor(self.register_address)
 
         # don't re-read 'char2' (Version/BMS S_N/Pack S_N) as these are static
         if factor == 'char2' and self.register_raw is not None:
-            return
+            return True
 
         # skip 'computed' registers
         if factor == 'comp':
-            return
+            return True
+
+        result_list = read_registers(instrument, register_address=self.register_address,
+                                     number_of_registers=get_count(self.register_address))
+        self.decode(result_list)
+        return result_list[0] is not None
 
+    def decode(self, result_list: list) -> None:
+        """store result_list from read_registers (or a replayed journal) into register_raw/register_scaled"""
+        factor = get_factor(self.register_address)
         count = get_count(self.register_address)
-        result_list = read_registers(instrument, register_address=self.register_address, number_of_registers=count)
         self.register_raw = result_list[0]
         if count == 1:
             # single register - int / uint / float
@@ -240,6 +337,7 @@ class AM2battery:
         self.register_data = {} # dict()
         self.itr = None
         self.time=time.strftime('%FT%T%z')
+        self.read_ok = False # result of the last read_battery()
 
         # create dict of know registers
         for reg in AM2_REGISTERS_DICT:
@@ -265,8 +363,10 @@ class AM2battery:
                                        'register_scaled': reg.register_scaled,
                                        'unit': reg.unit }
 
-    def calc_computed(self):
-        """calc min min avg diff - cell voltages 15..27"""
+    def calc_computed(self, timestamp: float = None):
+        """calc min min avg diff - cell voltages 15..27
+        timestamp = time.time() of the read for register 'Time', default now
+        """
         tot_val = max_val = min_val = self.register_data[AM2_REGISTER_VCELL_START].register_scaled
         max_id = min_id = 1
         for cell in range(1, AM2_VCELL_COUNT):
@@ -290,17 +390,474 @@ class AM2battery:
                                                        self.register_data[1].register_scaled, 1)  # Power = Watts = A * V
 
         self.register_data[1010].register_scaled=self.station_address
-        self.register_data[1011].register_scaled=time.strftime('%FT%T%z')
+        self.register_data[1011].register_scaled=time.strftime('%FT%T%z', time.localtime(timestamp))
 
-    def read_battery(self) -> None:
-        """read all register_data of a battery"""
+    def read_battery(self, stop_on_error: bool = False) -> bool:
+        """read all register_data of a battery, return False if any read failed
+        stop_on_error = give up on the first failed register, eg to fail over quickly
+        """
         self.instrument.address = self.station_address
         self.time=time.strftime('%FT%T%z')
+        self.read_ok = True
         for reg in self.register_data.values():
-            reg.read_1_register(self.instrument)
+            if not reg.read_1_register(self.instrument):
+                self.read_ok = False
+                if stop_on_error:
+                    capture_write('write_cycle', self.station_address, False)
+                    return False
 
         self.calc_computed()
+        capture_write('write_cycle', self.station_address, self.read_ok)
+        return self.read_ok
 
     def get_string(self, key: str) -> str:
         """extract 'Version', 'S_N_BMS', 'S_N_Pack' from register_data"""
         return self.register_data[AM2_STRING_DICT[key]].register_scaled
+
+
+@dataclass(init=False)
+class AM2Bank:
+    """Aggregate of a bank of AM2batteries, published as one device
+    Call update() once per read cycle, after read_battery() of all batteries.
+    Batteries whose read failed this cycle (battery.read_ok False) are left out of the totals.
+    Energy_Charge / Energy_Discharge integrate Power (trapezoidal) and are
+    persisted to state_file (json) so they survive a restart.
+    """
+    def __init__(self, state_file: str = None, max_gap: float = 600.0) -> None:
+        """constructor - max_gap: seconds between updates above which Power is not integrated"""
+        self.state_file = state_file
+        self.max_gap = max_gap
+        self.register_data = {} # dict()
+        self.itr = None
+        self.version = "??"
+        self.last_power = None # Power, timestamp and station addresses read ok of the previous update
+        self.last_timestamp = None
+        self.last_read_ok = None
+
+        for reg, info in AM2_BANK_REGISTERS_DICT.items():
+            self.register_data[reg] = Register(reg)
+            self.register_data[reg].name = info['name']
+            self.register_data[reg].unit = info['unit']
+            self.register_data[reg].register_scaled = 0
+
+        self.load_state()
+
+    def __iter__(self):
+        """ implement iterator over register_data """
+        self.itr = iter(self.register_data)
+        return self
+
+    def __next__(self):
+        """ implement iterator over register_data """
+        key = next(self.itr)
+        reg = self.register_data[key]
+        return reg.register_address, { 'name': reg.name,
+                                       'register_scaled': reg.register_scaled,
+                                       'unit': reg.unit }
+
+    def get_string(self, key: str) -> str:
+        """'Version' of the batteries in the bank - for HASS discovery"""
+        return self.version if key == 'Version' else "??"
+
+    def load_state(self) -> None:
+        """load energy counters from state_file"""
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, encoding='utf-8') as state:
+                energy = json.load(state)
+            self.register_data[2010].register_scaled = float(energy['Energy_Charge'])
+            self.register_data[2011].register_scaled = float(energy['Energy_Discharge'])
+        except (OSError, ValueError, KeyError) as ex:
+            logger.warning("AM2Bank: ignoring state_file=%s, exception=%s", self.state_file, ex)
+
+    def save_state(self) -> None:
+        """save energy counters to state_file, atomic replace"""
+        if self.state_file is None:
+            return
+        energy = { 'Energy_Charge': self.register_data[2010].register_scaled,
+                   'Energy_Discharge': self.register_data[2011].register_scaled }
+        tmp_file = self.state_file + ".tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as state:
+                json.dump(energy, state)
+            os.replace(tmp_file, self.state_file)
+        except OSError as ex:
+            logger.warning("AM2Bank: can't save state_file=%s, exception=%s", self.state_file, ex)
+
+    def integrate_power(self, power: float, timestamp: float, read_ok: frozenset) -> None:
+        """trapezoidal integration of Power into Energy_Charge / Energy_Discharge Wh
+        read_ok = station addresses summed in power, the interval is only integrated
+        if the previous sample summed the same batteries
+        """
+        last_power, last_timestamp, last_read_ok = self.last_power, self.last_timestamp, self.last_read_ok
+        self.last_power, self.last_timestamp, self.last_read_ok = power, timestamp, read_ok
+        if last_timestamp is None:
+            return
+        seconds = timestamp - last_timestamp
+        if read_ok != last_read_ok:
+            logger.warning("AM2Bank: batteries read ok changed %s -> %s, not integrating %0.0fs of Power",
+                           sorted(last_read_ok), sorted(read_ok), seconds)
+            return
+        if seconds <= 0 or seconds > self.max_gap:
+            logger.warning("AM2Bank: %0.0fs since last update (max_gap=%0.0fs), not integrating Power", seconds, self.max_gap)
+            return
+        hours = seconds / 3600.0
+
+        if last_power * power >= 0:
+            energy_charge = max(last_power + power, 0) / 2 * hours
+            energy_discharge = max(-(last_power + power), 0) / 2 * hours
+        else:
+            # Power crosses 0 - split the trapezoid into two triangles at the crossing
+            crossing = last_power / (last_power - power) # 0..1 of the interval
+            energy_1 = last_power / 2 * hours * crossing
+            energy_2 = power / 2 * hours * (1 - crossing)
+            energy_charge = max(energy_1, energy_2)
+            energy_discharge = -min(energy_1, energy_2)
+
+        self.register_data[2010].register_scaled = round(self.register_data[2010].register_scaled + energy_charge, 3)
+        self.register_data[2011].register_scaled = round(self.register_data[2011].register_scaled + energy_discharge, 3)
+
+    def update(self, batteries: list, timestamp: float = None) -> None:
+        """aggregate one read cycle of batteries - timestamp defaults to time.monotonic()
+        batteries with read_ok False hold stale values and are skipped,
+        Power is integrated while the same batteries read ok (eg a dead battery doesn't stop the counters)
+        """
+        if not batteries:
+            return
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        batteries = [battery for battery in batteries if battery.read_ok]
+        self.register_data[2012].register_scaled = len(batteries)
+        self.register_data[2013].register_scaled = time.strftime('%FT%T%z')
+        if not batteries:
+            logger.warning("AM2Bank: no battery read ok this cycle")
+            return
+
+        power = current = voltage = soc_ah = capacity_remain = capacity_full = 0.0
+        vcell_min = vcell_max = None
+        for battery in batteries:
+            data = battery.register_data
+            power += data[1006].register_scaled
+            current += data[0].register_scaled
+            voltage += data[1].register_scaled
+            soc_ah += data[2].register_scaled * data[5].register_scaled
+            capacity_remain += data[4].register_scaled
+            capacity_full += data[5].register_scaled
+            if vcell_min is None or data[1003].register_scaled < vcell_min:
+                vcell_min, vcell_min_address = data[1003].register_scaled, battery.station_address
+            if vcell_max is None or data[1001].register_scaled > vcell_max:
+                vcell_max, vcell_max_address = data[1001].register_scaled, battery.station_address
+
+        self.version = batteries[0].get_string('Version')
+        self.register_data[2000].register_scaled = round(power, 1)
+        self.register_data[2001].register_scaled = round(current, 2)
+        self.register_data[2002].register_scaled = round(voltage / len(batteries), 2)
+        self.register_data[2003].register_scaled = round(soc_ah / capacity_full, 1) if capacity_full else 0
+        self.register_data[2004].register_scaled = round(capacity_remain, 2)
+        self.register_data[2005].register_scaled = round(capacity_full, 2)
+        self.register_data[2006].register_scaled = vcell_min
+        self.register_data[2007].register_scaled = vcell_min_address
+        self.register_data[2008].register_scaled = vcell_max
+        self.register_data[2009].register_scaled = vcell_max_address
+
+        self.integrate_power(power, timestamp, frozenset(battery.station_address for battery in batteries))
+        self.save_state()
+
+
+class AM2multiport:
+    """Poll a bank of AM2batteries over several RS485 ports (instruments) in parallel
+    discover() probes station_address 1..max_address on every port and finds the paths
+    (port, station_address) to each battery, deduplicated by S_N_Pack.
+    Each battery is assigned to the least loaded port, read_bank() reads every port in its own thread.
+    Ports that see the same battery are on the same RS485 bus (splitter), their reads are serialized.
+    If a battery fails to read it fails over to another path.
+    Station addresses must be unique across the bank (mqtt device names, capture journal),
+    discover() raises ValueError if different batteries use the same station_address.
+    """
+    def __init__(self, instruments: list, max_address: int = 1, know_registers_only: bool = True,
+                 reprobe_every: int = 15) -> None:
+        """constructor - instruments = list of minimalmodbus.Instrument, one per port
+        reprobe_every = read_bank() calls between probes of station addresses not found yet
+        """
+        self.instruments = instruments
+        self.max_address = max_address
+        self.know_registers_only = know_registers_only
+        self.reprobe_every = reprobe_every
+        self.found = [{} for _ in instruments] # per port: dict() station_address: S_N_Pack
+        self.paths = {} # dict() key: list of (port, station_address) - key = S_N_Pack, or (port, station_address)
+        self.port_of = {} # dict() key: port currently assigned
+        self.bank = {} # dict() key: AM2battery
+        self.bus_lock = [threading.Lock() for _ in instruments] # one lock per RS485 bus, shared by ports on the same bus
+        self.missing = set() # station addresses not found on any port
+        self.read_count = 0
+
+    def probe(self, port: int, station_address: int) -> str:
+        """return S_N_Pack of the battery at station_address on port, None if no answer"""
+        instrument = self.instruments[port]
+        count = get_count(AM2_STRING_DICT['S_N_Pack'])
+        for _ in range(AM2_READ_RETRY):
+            try:
+                instrument.address = station_address
+                result_list = read_registers_once(instrument, AM2_STRING_DICT['S_N_Pack'], count)
+                return "".join(scale_raw_register('char2', raw, "??") for raw in result_list).rstrip()
+            except Exception: # pylint: disable=broad-except
+                # another port on the same bus may be probing - back off a random time
+                time.sleep(random.uniform(0, 2 * AM2_READ_DELAY))
+        return None
+
+    def probe_port(self, port: int, station_addresses) -> dict:
+        """return dict() station_address: S_N_Pack of station_addresses answering on port"""
+        found = {}
+        for station_address in station_addresses:
+            s_n_pack = self.probe(port, station_address)
+            if s_n_pack is not None:
+                found[station_address] = s_n_pack
+        logger.info("AM2multiport: port=%d, found=%s", port, found)
+        return found
+
+    def discover(self) -> dict:
+        """probe all ports, assign batteries to ports - returns self.paths
+        raises ValueError if different batteries use the same station_address
+        """
+        all_addresses = range(1, self.max_address + 1)
+        with ThreadPoolExecutor(max_workers=len(self.instruments)) as executor:
+            found = list(executor.map(lambda port: self.probe_port(port, all_addresses), range(len(self.instruments))))
+
+        # ports on the same bus probed at the same time and may have collided:
+        # re-probe, one at a time, addresses that answered on another port but not on this one
+        for port, port_found in enumerate(found):
+            seen_elsewhere = set().union(*found) - set(port_found)
+            for station_address in sorted(seen_elsewhere):
+                s_n_pack = self.probe(port, station_address)
+                if s_n_pack is not None:
+                    port_found[station_address] = s_n_pack
+
+        self.found = found
+        self.update_paths()
+        return self.paths
+
+    def reprobe(self) -> None:
+        """probe station addresses not found yet, one port at a time"""
+        new_found = [dict(port_found) for port_found in self.found]
+        for port, port_found in enumerate(new_found):
+            port_found.update(self.probe_port(port, sorted(self.missing)))
+        if new_found == self.found:
+            return
+        old_found, self.found = self.found, new_found
+        try:
+            self.update_paths()
+        except ValueError as ex:
+            self.found = old_found
+            logger.warning("AM2multiport: ignoring new batteries, %s", ex)
+
+    @staticmethod
+    def is_unique(s_n_pack: str) -> bool:
+        """S_N_Pack can identify a battery - not blank or unreadable"""
+        return s_n_pack != "" and "?" not in s_n_pack
+
+    def update_paths(self) -> None:
+        """build paths / bus locks from self.found, assign new batteries to the least loaded port"""
+        # S_N_Pack seen at two station addresses on one port can't identify a battery
+        not_unique = set()
+        for port_found in self.found:
+            s_n_packs = list(port_found.values())
+            not_unique.update(sn for sn in s_n_packs if s_n_packs.count(sn) > 1 or not self.is_unique(sn))
+
+        paths = {}
+        for port, port_found in enumerate(self.found):
+            for station_address, s_n_pack in sorted(port_found.items()):
+                key = (port, station_address) if s_n_pack in not_unique else s_n_pack
+                paths.setdefault(key, []).append((port, station_address))
+        for s_n_pack in sorted(not_unique):
+            logger.warning("AM2multiport: S_N_Pack='%s' does not identify a battery, using port/station_address", s_n_pack)
+
+        # ports that see the same battery share a bus
+        bus_of = list(range(len(self.instruments)))
+        for key, key_paths in paths.items():
+            if isinstance(key, str):
+                bus = min(bus_of[port] for port, _ in key_paths)
+                for port, _ in key_paths:
+                    old_bus = bus_of[port]
+                    bus_of = [bus if other_bus == old_bus else other_bus for other_bus in bus_of]
+
+        # same station_address on the same bus without a usable S_N_Pack = same battery
+        port_keys = sorted(key for key in paths if not isinstance(key, str))
+        for key in port_keys:
+            for other in port_keys:
+                if (other < key and other in paths and key in paths
+                        and other[1] == key[1] and bus_of[other[0]] == bus_of[key[0]]):
+                    paths[other].extend(paths.pop(key))
+
+        station_addresses = {}
+        for key, key_paths in paths.items():
+            for _, station_address in key_paths:
+                station_addresses.setdefault(station_address, set()).add(key)
+        conflicts = {addr: keys for addr, keys in station_addresses.items() if len(keys) > 1}
+        if conflicts:
+            raise ValueError(f"AM2multiport: different batteries use the same station_address {conflicts}")
+
+        self.paths = paths
+        locks = {bus: threading.Lock() for bus in set(bus_of)}
+        self.bus_lock = [locks[bus] for bus in bus_of]
+        for key in [key for key in self.bank if key not in paths]:
+            del self.bank[key]
+            del self.port_of[key]
+
+        # least loaded port first, batteries with fewest paths are placed first
+        load = [0] * len(self.instruments)
+        for key, port in self.port_of.items():
+            load[port] += 1
+        for key in sorted(paths, key=lambda key: len(paths[key])):
+            if key in self.bank:
+                continue
+            port, station_address = min(paths[key], key=lambda path: load[path[0]])
+            load[port] += 1
+            self.assign(key, port, station_address)
+
+        self.missing = set(range(1, self.max_address + 1)) - set(station_addresses)
+        logger.info("AM2multiport: batteries=%d, ports=%d, load=%s", len(self.bank), len(self.instruments), load)
+        if self.missing:
+            logger.warning("AM2multiport: station_address=%s not found on any port, probing again every %d reads",
+                           sorted(self.missing), self.reprobe_every)
+
+    def assign(self, key, port: int, station_address: int) -> None:
+        """read battery key via port/station_address"""
+        self.port_of[key] = port
+        if key not in self.bank:
+            self.bank[key] = AM2battery(self.instruments[port], station_address, self.know_registers_only)
+        battery = self.bank[key]
+        battery.instrument = self.instruments[port]
+        battery.station_address = station_address
+
+    def read_1_battery(self, key) -> bool:
+        """read one battery on its assigned port, fail over to another path on error
+        stop_on_error is only used while there is another path to fail over to,
+        the last path reads all registers and calc_computed() as read_battery() does
+        """
+        battery = self.bank[key]
+        port = self.port_of[key]
+        key_paths = [(port, battery.station_address)] + [path for path in self.paths[key] if path[0] != port]
+        for index, (path_port, station_address) in enumerate(key_paths):
+            if index > 0:
+                logger.warning("AM2multiport: battery=%s fail over port=%d -> port=%d, station_address=%d",
+                               key, port, path_port, station_address)
+                self.assign(key, path_port, station_address)
+            with self.bus_lock[path_port]:
+                if battery.read_battery(stop_on_error=index < len(key_paths) - 1):
+                    return True
+        return False
+
+    def read_port(self, port: int) -> list:
+        """read all batteries assigned to port - returns list of keys that failed to read"""
+        return [key for key in [key for key, key_port in self.port_of.items() if key_port == port]
+                if not self.read_1_battery(key)]
+
+    def read_bank(self) -> list:
+        """read all batteries, one thread per port - returns list of AM2battery sorted by station_address
+        battery.read_ok is False for batteries that failed to read on every path
+        """
+        self.read_count += 1
+        if self.missing and self.read_count % self.reprobe_every == 0:
+            self.reprobe()
+        with ThreadPoolExecutor(max_workers=len(self.instruments)) as executor:
+            failed = [key for port_failed in executor.map(self.read_port, range(len(self.instruments)))
+                      for key in port_failed]
+        if failed:
+            logger.warning("AM2multiport: read failed on all paths, batteries=%s", failed)
+        return sorted(self.bank.values(), key=lambda battery: battery.station_address)
+
+
+class ReplayInstrument:
+    """stand-in for minimalmodbus.Instrument when replaying a journal - never touches RS485"""
+    def __init__(self, station_address: int) -> None:
+        """constructor"""
+        self.address = station_address
+        self.roundtrip_time = 0.0
+
+    def read_registers(self, registeraddress: int, number_of_registers: int = 1) -> list:
+        """replayed batteries are fed from the journal, not via read_registers"""
+        raise RuntimeError(f"ReplayInstrument: no live read of register {registeraddress}")
+
+
+class AM2replay:
+    """Replay a FrameJournal (see start_capture) thru decode / calc_computed
+    Iterating yields an AM2battery after each read cycle of a battery (RECORD_CYCLE written by read_battery),
+    the same AM2battery object is updated and yielded again for the next cycle.
+    Batteries are identified by station_address, unique across the bank (see AM2multiport).
+    speed = 0 replays as fast as possible, 1.0 = original pacing, 10.0 = 10x faster
+    """
+    def __init__(self, path: str, know_registers_only: bool = True, speed: float = 0.0) -> None:
+        """constructor"""
+        self.path = path
+        self.know_registers_only = know_registers_only
+        self.speed = speed
+        self.bank = {} # dict() station_address: AM2battery
+        self.frame_count = 0
+        self.error_count = 0
+        self.cycle_count = 0
+        self.journal_time = 0.0 # seconds of capture replayed, sum of all capture sessions (not the downtime between)
+
+    def get_battery(self, station_address: int) -> AM2battery:
+        """return the AM2battery for station_address, create on first use"""
+        if station_address not in self.bank:
+            self.bank[station_address] = AM2battery(ReplayInstrument(station_address), station_address,
+                                                    self.know_registers_only)
+        return self.bank[station_address]
+
+    def __iter__(self):
+        """ replay journal, yield AM2battery after each read cycle
+        battery.time and register 'Time' are the wall clock of the capture, not of the replay
+        """
+        # per station_address: (register_address, result_list) of the last transaction, retries overwrite it
+        # tracked per station as AM2multiport interleaves the batteries of several ports in one journal
+        pending = {}
+        cycle_start = {} # per station_address: time.time() of the first frame of the cycle
+        session = session_start = None
+        done_time = 0.0 # journal_time of the previous sessions
+        t0_replay = time.monotonic()
+        with FrameJournal(self.path) as journal:
+            for kind, t_request, t_response, request, response in journal:
+                if journal.session != session:
+                    session, session_start, done_time = journal.session, t_request, self.journal_time
+                self.journal_time = max(self.journal_time, done_time + t_response - session_start)
+                if self.speed > 0:
+                    delay = (done_time + t_request - session_start) / self.speed - (time.monotonic() - t0_replay)
+                    if delay > 0:
+                        time.sleep(delay)
+
+                # wall clock of the capture - monotonic time restarts when the journal is appended after a reboot
+                t_wall = t_response + journal.wall_offset
+                if kind == RECORD_CYCLE:
+                    station_address, read_ok = request[0], bool(request[1])
+                    battery = self.get_battery(station_address)
+                    if station_address in pending:
+                        self.decode(battery, *pending.pop(station_address))
+                    battery.time = time.strftime('%FT%T%z', time.localtime(cycle_start.pop(station_address, t_wall)))
+                    battery.read_ok = read_ok
+                    battery.calc_computed(t_wall)
+                    self.cycle_count += 1
+                    yield battery
+                    continue
+
+                self.frame_count += 1
+                station_address, register_address, number_of_registers = parse_request_frame(request)
+                if kind == RECORD_ERROR:
+                    self.error_count += 1
+                    logger.debug("replay: station_address=%d, register_address=%d, error=%s",
+                                 station_address, register_address, response.decode('utf-8', 'replace'))
+                    result_list = [None] * number_of_registers
+                else:
+                    result_list = parse_response_frame(response, number_of_registers)
+                battery = self.get_battery(station_address)
+                cycle_start.setdefault(station_address, t_request + journal.wall_offset)
+                if station_address in pending and pending[station_address][0] != register_address:
+                    self.decode(battery, *pending[station_address])
+                pending[station_address] = (register_address, result_list)
+        # frames after the last RECORD_CYCLE are an incomplete read cycle - not yielded
+
+    @staticmethod
+    def decode(battery: AM2battery, register_address: int, result_list: list) -> None:
+        """decode a replayed result_list into the battery register"""
+        if register_address not in battery.register_data:
+            battery.register_data[register_address] = Register(register_address)
+        battery.register_data[register_address].decode(result_list)
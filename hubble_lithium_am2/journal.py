@@ -0,0 +1,140 @@
+"""
+    Description: Capture modbus request/response frames to a binary journal
+    Author:      Alberto da Silva
+    License:     MIT
+
+    A journal is a small header followed by records:
+        JOURNAL_RECORD - kind, t_request, t_response (time.monotonic()),
+                         length of request, length of response
+        request        - modbus RTU read holding registers (function 0x03) incl CRC
+        response       - RECORD_FRAME: modbus RTU response incl CRC
+                         RECORD_ERROR: the exception of the failed read, "ExceptionClass: message" utf-8
+    Each time the journal is opened for capture a RECORD_ANCHOR is written first:
+        t_request = time.time(), t_response = time.monotonic()
+    so replayed frames can be lined up with log files / HASS history (wall clock).
+    read_battery() ends each read cycle with a RECORD_CYCLE:
+        request = station_address, read_ok (2 bytes)
+
+    The frames are rebuilt from the arguments/result of instrument.read_registers()
+    so capture works with any minimalmodbus version (no private minimalmodbus API).
+"""
+
+import time
+import struct
+
+JOURNAL_MAGIC = b'AM2J\x03'           # file header: 'AM2J' + format version
+JOURNAL_RECORD = struct.Struct('<BddBH')
+JOURNAL_ERROR_MAX = 1000               # max bytes of an exception message
+
+RECORD_FRAME = 0  # request + response frame
+RECORD_ERROR = 1  # request frame + exception of the failed read
+RECORD_ANCHOR = 2 # time.time() / time.monotonic() of the capture session
+RECORD_CYCLE = 3  # end of a read_battery() cycle
+MODBUS_READ_HOLDING_REGISTERS = 0x03
+
+
+def modbus_crc(frame: bytes) -> bytes:
+    """return modbus RTU CRC16 of frame, little endian"""
+    crc = 0xFFFF
+    for byte in frame:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc.to_bytes(2, 'little')
+
+
+def build_request_frame(station_address: int, register_address: int, number_of_registers: int) -> bytes:
+    """return modbus RTU 'read holding registers' request frame"""
+    frame = struct.pack('>BBHH', station_address, MODBUS_READ_HOLDING_REGISTERS, register_address, number_of_registers)
+    return frame + modbus_crc(frame)
+
+
+def build_response_frame(station_address: int, values: list) -> bytes:
+    """return modbus RTU 'read holding registers' response frame"""
+    frame = struct.pack(f'>BBB{len(values)}H', station_address, MODBUS_READ_HOLDING_REGISTERS, 2 * len(values), *values)
+    return frame + modbus_crc(frame)
+
+
+def parse_request_frame(frame: bytes) -> tuple:
+    """return station_address, register_address, number_of_registers from a request frame"""
+    station_address, _function, register_address, number_of_registers = struct.unpack_from('>BBHH', frame)
+    return station_address, register_address, number_of_registers
+
+
+def parse_response_frame(frame: bytes, number_of_registers: int) -> list:
+    """return list of register values from a response frame, [None] * number_of_registers if empty/corrupt"""
+    if len(frame) != 5 + 2 * number_of_registers or modbus_crc(frame[:-2]) != frame[-2:]:
+        return [None] * number_of_registers
+    return list(struct.unpack_from(f'>{number_of_registers}H', frame, 3))
+
+
+class FrameJournal:
+    """Binary journal of modbus request/response frames"""
+    def __init__(self, path: str, mode: str = 'rb') -> None:
+        """constructor - mode 'rb' to read, 'wb'/'ab' to capture"""
+        self.path = path
+        self.wall_offset = 0.0 # time.time() - time.monotonic() of the last anchor read
+        self.session = 0 # number of anchors read = capture sessions
+        self.file = open(path, mode) # pylint: disable=consider-using-with
+        if mode == 'rb':
+            if self.file.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+                self.file.close()
+                raise ValueError(f"{path} is not an AM2 frame journal")
+        else:
+            if self.file.tell() == 0:
+                self.file.write(JOURNAL_MAGIC)
+            self.write_record(RECORD_ANCHOR, time.time(), time.monotonic(), b'', b'')
+
+    def write_record(self, kind: int, t_request: float, t_response: float, request: bytes, response: bytes) -> None:
+        """append one record to the journal"""
+        # single write() so records from several threads (AM2multiport) don't interleave
+        self.file.write(JOURNAL_RECORD.pack(kind, t_request, t_response, len(request), len(response)) + request + response)
+
+    def write(self, t_request: float, t_response: float, request: bytes, response: bytes) -> None:
+        """append one transaction to the journal"""
+        self.write_record(RECORD_FRAME, t_request, t_response, request, response)
+
+    def write_error(self, t_request: float, t_response: float, request: bytes, exception: Exception) -> None:
+        """append a failed transaction and its exception to the journal"""
+        error = f"{type(exception).__name__}: {exception}".encode('utf-8', 'replace')[:JOURNAL_ERROR_MAX]
+        self.write_record(RECORD_ERROR, t_request, t_response, request, error)
+
+    def write_cycle(self, station_address: int, read_ok: bool) -> None:
+        """append end of a read cycle of station_address"""
+        now = time.monotonic()
+        self.write_record(RECORD_CYCLE, now, now, bytes([station_address, int(read_ok)]), b'')
+
+    def __iter__(self):
+        """ iterate over journal - yields kind, t_request, t_response, request, response
+        t_request/t_response are time.monotonic() of the capture, add self.wall_offset for time.time()
+        RECORD_ANCHOR is not yielded, it sets self.wall_offset and self.session
+        """
+        read = self.file.read
+        while True:
+            header = read(JOURNAL_RECORD.size)
+            if len(header) < JOURNAL_RECORD.size:
+                return # end of journal, or truncated last record
+            kind, t_request, t_response, request_len, response_len = JOURNAL_RECORD.unpack(header)
+            request = read(request_len)
+            response = read(response_len)
+            if len(response) < response_len:
+                return
+            if kind == RECORD_ANCHOR:
+                self.wall_offset = t_request - t_response
+                self.session += 1
+                continue
+            yield kind, t_request, t_response, request, response
+
+    def flush(self) -> None:
+        """flush captured frames to disk"""
+        self.file.flush()
+
+    def close(self) -> None:
+        """close the journal"""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
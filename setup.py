@@ -1,7 +1,7 @@
 from setuptools import setup
 
 setup(name='hubble_lithium_am2',
-      version='0.9.2',
+      version='0.9.3',
       description='Read Hubble Lithium AM2 BMS registers via RS485/modbus',
       url='https://github.com/mysystem32/hubble_lithium_am2',
       author='Alberto da Silva',